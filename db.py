@@ -1,11 +1,21 @@
+import atexit
 import os
 import sys
+from contextlib import contextmanager
 from dotenv import load_dotenv
 import psycopg
-import numpy as np
+from psycopg_pool import ConnectionPool, PoolTimeout
+from pgvector import HalfVector
+from pgvector.psycopg import register_vector
 
 load_dotenv()
 
+# Bulk inserts larger than this are streamed with COPY instead of pipelined INSERTs
+COPY_THRESHOLD = 500
+
+# Set once create_patient_vectors_table has run in this process
+_TABLE_READY = False
+
 # Load Neon database connection string from environment variable
 NEON_DB_URL = os.getenv("NEON_DB_URL")
 
@@ -14,11 +24,52 @@ if not NEON_DB_URL:
     print("Please create a .env file with your Neon database connection string.")
     sys.exit(1)
 
-# Connect to Neon Postgres database with error handling
+def configure_connection(conn):
+    """Register pgvector types on a pooled connection
+
+    With the types registered, embeddings travel in pgvector's binary format
+    (2 bytes per dimension for halfvec) instead of as text literals.
+    On a fresh database the extension does not exist until
+    create_patient_vectors_table runs, so registration is skipped here and
+    retried when the connection is next borrowed.
+    """
+    try:
+        register_vector(conn)
+        conn.commit()
+    except psycopg.ProgrammingError:
+        # vector type not found: the extension hasn't been created yet
+        conn.rollback()
+
+# Keep a small pool of open connections so each query skips the TCP/TLS/auth handshake
+# prepare_threshold=1 prepares a statement server-side the second time a connection runs it,
+# so the hot similarity query is parsed and planned once per pooled connection
+POOL = ConnectionPool(
+    NEON_DB_URL, min_size=2, max_size=10, kwargs={"prepare_threshold": 1},
+    configure=configure_connection, open=True,
+)
+atexit.register(POOL.close)
+
+# Fail fast on a bad connection string instead of on the first query
+try:
+    POOL.wait(timeout=10)
+except PoolTimeout:
+    # The pool keeps retrying in the background and only reports a timeout,
+    # so connect once directly to surface the real error (bad host, auth, ...)
+    try:
+        psycopg.connect(NEON_DB_URL, connect_timeout=10).close()
+        error = "timed out waiting for a connection"
+    except psycopg.OperationalError as e:
+        error = e
+    print(f"Database connection failed: {error}")
+    print("Please check your NEON_DB_URL in the .env file.")
+    sys.exit(1)
+
+# Borrow a pooled Neon Postgres connection with error handling
+@contextmanager
 def get_db_connection():
-    """Establish database connection with error handling"""
+    """Borrow a database connection from the pool, returning it on exit"""
     try:
-        return psycopg.connect(NEON_DB_URL)
+        conn = POOL.getconn()
     except psycopg.OperationalError as e:
         print(f"Database connection failed: {e}")
         print("Please check your NEON_DB_URL in the .env file.")
@@ -26,83 +77,257 @@ def get_db_connection():
     except Exception as e:
         print(f"Unexpected database error: {e}")
         sys.exit(1)
-
-def create_patient_vectors_table():
-    """Create the patient vectors table with pgvector extension"""
-    conn = get_db_connection()
     try:
-        with conn.cursor() as cur:
-            # Enable pgvector extension
-            cur.execute("CREATE EXTENSION IF NOT EXISTS vector;")
-            # Create table for patient data vectors (384 dimensions for all-MiniLM-L6-v2)
-            cur.execute("""
-                CREATE TABLE IF NOT EXISTS patient_data_vectors (
-                    id SERIAL PRIMARY KEY,
-                    patient_id VARCHAR NOT NULL,
-                    data_type VARCHAR NOT NULL,
-                    content TEXT,
-                    embedding vector(384),
-                    timestamp TIMESTAMPTZ DEFAULT now(),
-                    doctor_id VARCHAR,
-                    visit_id VARCHAR
-                );
-            """)
-            conn.commit()
-            print("Database table created successfully.")
-    except Exception as e:
-        print(f"Error creating table: {e}")
-        conn.rollback()
-        raise
+        if conn.adapters.types.get("vector") is None:
+            configure_connection(conn)
+        yield conn
     finally:
-        conn.close()
+        POOL.putconn(conn)
+
+def create_patient_vectors_table():
+    """Create the patient vectors table with pgvector extension (once per process)"""
+    global _TABLE_READY
+    if _TABLE_READY:
+        return
+    with get_db_connection() as conn:
+        try:
+            with conn.cursor() as cur:
+                # Enable pgvector extension, and pgcrypto for digest()
+                cur.execute("CREATE EXTENSION IF NOT EXISTS vector;")
+                cur.execute("CREATE EXTENSION IF NOT EXISTS pgcrypto;")
+                # Create table for patient data vectors (384 dimensions for all-MiniLM-L6-v2).
+                # halfvec stores FP16 values: half the bytes per row and per index entry of vector(384)
+                cur.execute("""
+                    CREATE TABLE IF NOT EXISTS patient_data_vectors (
+                        id SERIAL PRIMARY KEY,
+                        patient_id VARCHAR NOT NULL,
+                        data_type VARCHAR NOT NULL,
+                        content TEXT,
+                        embedding halfvec(384),
+                        timestamp TIMESTAMPTZ DEFAULT now(),
+                        doctor_id VARCHAR,
+                        visit_id VARCHAR
+                    );
+                """)
+                # Tables created before the switch to halfvec still have a vector column.
+                # Convert it in place; its old cosine index uses vector operators and has
+                # to go first, and the vectors are normalized to match the inner-product search.
+                cur.execute("""
+                    SELECT format_type(atttypid, atttypmod)
+                    FROM pg_attribute
+                    WHERE attrelid = 'patient_data_vectors'::regclass AND attname = 'embedding';
+                """)
+                if cur.fetchone()[0].startswith("vector"):
+                    print("Migrating embedding column from vector(384) to halfvec(384)...")
+                    cur.execute("DROP INDEX IF EXISTS patient_vec_hnsw;")
+                    cur.execute("DROP INDEX IF EXISTS patient_vec_hnsw_ip;")
+                    cur.execute("""
+                        ALTER TABLE patient_data_vectors
+                        ALTER COLUMN embedding TYPE halfvec(384)
+                        USING l2_normalize(embedding)::halfvec(384);
+                    """)
+                # Hash of the record text, so re-running the demos can skip records already stored
+                cur.execute("""
+                    ALTER TABLE patient_data_vectors
+                    ADD COLUMN IF NOT EXISTS content_hash BYTEA
+                    GENERATED ALWAYS AS (digest(content, 'sha256')) STORED;
+                """)
+                cur.execute("""
+                    CREATE UNIQUE INDEX IF NOT EXISTS patient_vec_content_unique
+                    ON patient_data_vectors (patient_id, data_type, content_hash);
+                """)
+                # Give the index build enough memory and workers to finish quickly.
+                # SET LOCAL keeps these from leaking into other users of the pooled connection.
+                cur.execute("SET LOCAL maintenance_work_mem = '2GB';")
+                cur.execute("SET LOCAL max_parallel_maintenance_workers = 7;")
+                # HNSW index for approximate nearest neighbour search.
+                # Embeddings are L2-normalized, so inner product ranks the same as cosine
+                # but is cheaper per distance evaluation. halfvec_ip_ops must match the <#>
+                # operator used in query_similar_vectors, otherwise the planner falls back
+                # to a sequential scan. Drop the older cosine index if it is still around.
+                cur.execute("DROP INDEX IF EXISTS patient_vec_hnsw;")
+                cur.execute("""
+                    CREATE INDEX IF NOT EXISTS patient_vec_hnsw_ip
+                    ON patient_data_vectors
+                    USING hnsw (embedding halfvec_ip_ops)
+                    WITH (m = 24, ef_construction = 128);
+                """)
+                conn.commit()
+                _TABLE_READY = True
+                print("Database table created successfully.")
+        except Exception as e:
+            print(f"Error creating table: {e}")
+            conn.rollback()
+            raise
 
 def insert_patient_vector(patient_id, data_type, content, embedding, doctor_id=None, visit_id=None):
     """Insert a patient record with its vector embedding into the database"""
-    conn = get_db_connection()
-    try:
-        with conn.cursor() as cur:
-            # Convert numpy array to list for PostgreSQL vector type
-            embedding_list = embedding.tolist() if hasattr(embedding, 'tolist') else embedding
-            
-            cur.execute("""
-                INSERT INTO patient_data_vectors (patient_id, data_type, content, embedding, doctor_id, visit_id)
-                VALUES (%s, %s, %s, %s, %s, %s);
-            """, (patient_id, data_type, content, embedding_list, doctor_id, visit_id))
-            conn.commit()
-    except Exception as e:
-        print(f"Error inserting vector: {e}")
-        conn.rollback()
-        raise
-    finally:
-        conn.close()
+    with get_db_connection() as conn:
+        try:
+            with conn.cursor() as cur:
+                # Wrap the numpy array so it is sent as a binary halfvec
+                cur.execute("""
+                    INSERT INTO patient_data_vectors (patient_id, data_type, content, embedding, doctor_id, visit_id)
+                    VALUES (%s, %s, %s, %s, %s, %s)
+                    ON CONFLICT (patient_id, data_type, content_hash) DO NOTHING;
+                """, (patient_id, data_type, content, HalfVector(embedding), doctor_id, visit_id))
+                conn.commit()
+        except Exception as e:
+            print(f"Error inserting vector: {e}")
+            conn.rollback()
+            raise
+
+def insert_patient_vectors_bulk(rows):
+    """Insert many patient records in a single pipelined transaction
+    
+    Args:
+        rows: Iterable of (patient_id, data_type, content, embedding, doctor_id, visit_id) tuples
+    """
+    rows = list(rows)
+    if not rows:
+        return
+    if len(rows) > COPY_THRESHOLD:
+        copy_patient_vectors(rows)
+        return
+    with get_db_connection() as conn:
+        try:
+            with conn.cursor() as cur:
+                # Pipeline mode sends every INSERT without waiting for each reply, so all rows
+                # share one round trip and one commit. The statement text stays the same for
+                # every row, letting the connection reuse a single prepared statement.
+                with conn.pipeline():
+                    for patient_id, data_type, content, embedding, doctor_id, visit_id in rows:
+                        cur.execute("""
+                            INSERT INTO patient_data_vectors (patient_id, data_type, content, embedding, doctor_id, visit_id)
+                            VALUES (%s, %s, %s, %s, %s, %s)
+                            ON CONFLICT (patient_id, data_type, content_hash) DO NOTHING;
+                        """, (patient_id, data_type, content, HalfVector(embedding), doctor_id, visit_id))
+                conn.commit()
+        except Exception as e:
+            print(f"Error inserting vectors: {e}")
+            conn.rollback()
+            raise
+
+def copy_patient_vectors(rows):
+    """Stream patient records into the database with COPY ... FROM STDIN
+    
+    COPY skips per-statement parsing and planning, so it is the fastest way
+    to load large numbers of embeddings. COPY has no ON CONFLICT clause, so rows
+    are staged in a temporary table and moved over with one INSERT ... SELECT.
+    
+    Args:
+        rows: Iterable of (patient_id, data_type, content, embedding, doctor_id, visit_id) tuples
+    """
+    with get_db_connection() as conn:
+        try:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    CREATE TEMP TABLE patient_vectors_staging (
+                        patient_id VARCHAR,
+                        data_type VARCHAR,
+                        content TEXT,
+                        embedding halfvec(384),
+                        doctor_id VARCHAR,
+                        visit_id VARCHAR
+                    ) ON COMMIT DROP;
+                """)
+                with cur.copy(
+                    "COPY patient_vectors_staging (patient_id, data_type, content, embedding, doctor_id, visit_id) "
+                    "FROM STDIN (FORMAT BINARY)"
+                ) as copy:
+                    # Binary COPY needs the column types up front
+                    copy.set_types(["varchar", "varchar", "text", "halfvec", "varchar", "varchar"])
+                    for patient_id, data_type, content, embedding, doctor_id, visit_id in rows:
+                        copy.write_row((patient_id, data_type, content, HalfVector(embedding), doctor_id, visit_id))
+                cur.execute("""
+                    INSERT INTO patient_data_vectors (patient_id, data_type, content, embedding, doctor_id, visit_id)
+                    SELECT patient_id, data_type, content, embedding, doctor_id, visit_id
+                    FROM patient_vectors_staging
+                    ON CONFLICT (patient_id, data_type, content_hash) DO NOTHING;
+                """)
+                conn.commit()
+        except Exception as e:
+            print(f"Error copying vectors: {e}")
+            conn.rollback()
+            raise
+
+def filter_new_patient_records(records):
+    """Drop records that are already stored, so they don't need to be embedded again
+    
+    A record is already stored when a row with the same patient_id, data_type
+    and content hash exists.
+    
+    Args:
+        records: List of tuples starting with (patient_id, data_type, content, ...)
+        
+    Returns:
+        List of the records not yet in the database, in their original order
+    """
+    if not records:
+        return []
+    with get_db_connection() as conn:
+        try:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    SELECT patient_id, data_type, content
+                    FROM patient_data_vectors
+                    WHERE content_hash = ANY(
+                        SELECT digest(c, 'sha256') FROM unnest(%s::text[]) AS c
+                    );
+                """, ([record[2] for record in records],))
+                stored = set(cur.fetchall())
+                conn.commit()
+        except Exception as e:
+            print(f"Error checking stored records: {e}")
+            conn.rollback()
+            raise
+    return [record for record in records if tuple(record[:3]) not in stored]
 
 def query_similar_vectors(query_embedding, top_k=5):
     """Query for similar vectors using cosine distance
     
+    Embeddings are unit length, so the search runs on pgvector's cheaper
+    negative inner product operator <#> and converts the result back to
+    cosine distance (1 - cosine similarity).
+    
     Args:
-        query_embedding: The embedding vector to search for
+        query_embedding: The L2-normalized embedding vector to search for
         top_k: Number of most similar results to return
         
     Returns:
         List of tuples: (patient_id, data_type, content, distance)
     """
-    conn = get_db_connection()
-    try:
-        with conn.cursor() as cur:
-            # Convert numpy array to list for PostgreSQL vector type
-            embedding_list = query_embedding.tolist() if hasattr(query_embedding, 'tolist') else query_embedding
-            
-            # Use cosine distance operator <=> for similarity search
-            cur.execute("""
-                SELECT patient_id, data_type, content, embedding <=> %s::vector AS distance
-                FROM patient_data_vectors
-                ORDER BY embedding <=> %s::vector
-                LIMIT %s;
-            """, (embedding_list, embedding_list, top_k))
-            results = cur.fetchall()
-            return results
-    except Exception as e:
-        print(f"Error querying vectors: {e}")
-        raise
-    finally:
-        conn.close()
+    with get_db_connection() as conn:
+        try:
+            with conn.cursor() as cur:
+                # Wrap the numpy array so it is sent as a binary halfvec
+                query_vector = HalfVector(query_embedding)
+
+                # Size the HNSW candidate list from top_k for this transaction only:
+                # small queries keep the default of 40, larger ones scan more to keep recall up
+                ef_search = max(40, top_k * 10)
+                try:
+                    cur.execute("SELECT set_config('hnsw.ef_search', %s, true);", (str(ef_search),))
+                except psycopg.errors.UndefinedObject:
+                    # Older pgvector without HNSW support; fall back to the server default
+                    conn.rollback()
+
+                # Use negative inner product operator <#> for similarity search.
+                # Ordering by the alias sends the query vector only once while
+                # still letting the planner use the HNSW index.
+                cur.execute("""
+                    SELECT patient_id, data_type, content, embedding <#> %s::halfvec AS neg_inner_product
+                    FROM patient_data_vectors
+                    ORDER BY neg_inner_product
+                    LIMIT %s;
+                """, (query_vector, top_k), prepare=True)
+                # For unit vectors, cosine distance = 1 - inner product = 1 + (<#> result)
+                results = [
+                    (patient_id, data_type, content, 1 + neg_inner_product)
+                    for patient_id, data_type, content, neg_inner_product in cur.fetchall()
+                ]
+                conn.commit()
+                return results
+        except Exception as e:
+            print(f"Error querying vectors: {e}")
+            raise
@@ -1,7 +1,59 @@
+import hashlib
+import os
+from collections import OrderedDict
+
+# CPU threads for inference. OpenMP/MKL read these variables when torch is
+# first imported, so they must be set before the imports below.
+CPU_THREADS = min(os.cpu_count() or 1, 8)
+os.environ.setdefault("OMP_NUM_THREADS", str(CPU_THREADS))
+os.environ.setdefault("MKL_NUM_THREADS", str(CPU_THREADS))
+
 from transformers import AutoTokenizer, AutoModel
 import torch
 import numpy as np
 
+# Optional: Intel Extension for PyTorch, enables oneDNN AMX/VNNI bf16 kernels on CPU
+try:
+    import intel_extension_for_pytorch as ipex
+except ImportError:
+    ipex = None
+
+# Optional: ONNX Runtime backend with int8 quantization for faster CPU inference
+try:
+    from optimum.onnxruntime import ORTModelForFeatureExtraction, ORTQuantizer
+    from optimum.onnxruntime.configuration import AutoQuantizationConfig
+except ImportError:
+    ORTModelForFeatureExtraction = None
+
+# Where export_quantized_onnx() writes the model and TextEmbedder looks for it
+ONNX_MODEL_DIR = "onnx_minilm"
+ONNX_QUANTIZED_FILE = "model_quantized.onnx"
+
+# Number of texts per forward pass in embed_batch
+EMBED_BATCH_SIZE = 32
+
+def export_quantized_onnx(model_name="sentence-transformers/all-MiniLM-L6-v2", output_dir=ONNX_MODEL_DIR):
+    """
+    Export a model to ONNX and quantize it to int8 (run once, requires optimum[onnxruntime]).
+    
+    The quantized graph uses fused operators and VNNI int8 dot products,
+    which is several times faster than the eager PyTorch model on CPU.
+    
+    Args:
+        model_name (str): Name of the Hugging Face model to export
+        output_dir (str): Directory to write the ONNX model and tokenizer to
+    """
+    if ORTModelForFeatureExtraction is None:
+        raise ImportError("ONNX export requires: pip install optimum[onnxruntime]")
+    model = ORTModelForFeatureExtraction.from_pretrained(model_name, export=True)
+    model.save_pretrained(output_dir)
+    AutoTokenizer.from_pretrained(model_name, use_fast=True).save_pretrained(output_dir)
+    
+    quantizer = ORTQuantizer.from_pretrained(model)
+    quantization_config = AutoQuantizationConfig.avx512_vnni(is_static=False, per_channel=False)
+    quantizer.quantize(save_dir=output_dir, quantization_config=quantization_config)
+    print(f"Quantized ONNX model saved to {output_dir}")
+
 class TextEmbedder:
     """
     Text embedding class using Hugging Face transformers.
@@ -13,22 +65,117 @@ class TextEmbedder:
     semantic similarity tasks and produces 384-dimensional embeddings.
     """
     
-    def __init__(self, model_name="sentence-transformers/all-MiniLM-L6-v2"):
+    def __init__(self, model_name="sentence-transformers/all-MiniLM-L6-v2", onnx_model_dir=ONNX_MODEL_DIR,
+                 cache_path=None, cache_size=100_000):
         """
         Initialize the text embedder with a pre-trained model.
         
         Args:
             model_name (str): Name of the Hugging Face model to use.
                             Default is a sentence transformer optimized for similarity.
+            onnx_model_dir (str): Directory holding an int8 ONNX export of the model
+                            (see export_quantized_onnx). Used on CPU when present.
+            cache_path (str): Optional .npz file to load cached embeddings from
+                            and persist them to with save_cache().
+            cache_size (int): Maximum number of embeddings kept in the cache; the least
+                            recently used are evicted beyond this.
         """
         print(f"Loading embedding model: {model_name}")
         self.model_name = model_name
-        self.tokenizer = AutoTokenizer.from_pretrained(model_name)
-        self.model = AutoModel.from_pretrained(model_name)
+        # Rust-backed fast tokenizer: much quicker than the Python one and releases the GIL
+        self.tokenizer = AutoTokenizer.from_pretrained(model_name, use_fast=True)
+        self.device = "cuda" if torch.cuda.is_available() else "cpu"
+        self.autocast_dtype = None
+        
+        if self.device == "cpu":
+            # Use several cores for each forward pass
+            torch.set_num_threads(CPU_THREADS)
+            try:
+                torch.set_num_interop_threads(2)
+            except RuntimeError:
+                # Can only be set before torch runs any parallel work
+                pass
         
-        # Set model to evaluation mode for inference
-        self.model.eval()
-        print(f"Model loaded successfully. Embedding dimension: 384")
+        onnx_path = os.path.join(onnx_model_dir, ONNX_QUANTIZED_FILE) if onnx_model_dir else None
+        if (self.device == "cpu" and ORTModelForFeatureExtraction is not None
+                and onnx_path and os.path.exists(onnx_path)):
+            # Quantized ONNX Runtime graph: same inputs and outputs as the PyTorch model
+            self.model = ORTModelForFeatureExtraction.from_pretrained(onnx_model_dir, file_name=ONNX_QUANTIZED_FILE)
+            self.backend = "onnx-int8"
+        else:
+            self.model = AutoModel.from_pretrained(model_name)
+            
+            # Run on the GPU in FP16 when one is available; FP32 on CPU
+            self.model.to(self.device)
+            if self.device == "cuda":
+                self.model.half()
+                self.autocast_dtype = torch.float16
+            
+            # Set model to evaluation mode for inference
+            self.model.eval()
+            self.backend = "pytorch"
+            
+            if self.device == "cpu" and ipex is not None:
+                # bf16 weights and fused kernels that use AMX/VNNI on supporting CPUs
+                self.model = ipex.optimize(self.model, dtype=torch.bfloat16)
+                self.autocast_dtype = torch.bfloat16
+                self.backend = "pytorch-ipex-bf16"
+        print(f"Model loaded successfully on {self.device} ({self.backend}). Embedding dimension: 384")
+        
+        # LRU embedding cache keyed by a hash of (model name, text), so repeated
+        # texts skip the transformer forward pass entirely
+        self.cache_path = cache_path
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        if cache_path and os.path.exists(cache_path):
+            with np.load(cache_path) as data:
+                keys = [row.tobytes() for row in data["keys"]]
+                for key, embedding in zip(keys, data["vectors"]):
+                    self._cache_put(key, embedding)
+            print(f"Loaded {len(self._cache)} cached embeddings from {cache_path}")
+
+    def _autocast(self):
+        """Mixed-precision context for inference (FP16 on CUDA, bf16 with IPEX on CPU, otherwise disabled)."""
+        return torch.autocast(
+            device_type=self.device,
+            dtype=self.autocast_dtype or torch.bfloat16,
+            enabled=self.autocast_dtype is not None,
+        )
+
+    def _cache_key(self, text):
+        """16-byte hash of the model name and text, used as the embedding cache key."""
+        return hashlib.blake2b(f"{self.model_name}\0{text}".encode("utf-8"), digest_size=16).digest()
+
+    def _cache_get(self, key):
+        """Return a cached embedding (or None) and mark it as recently used."""
+        embedding = self._cache.get(key)
+        if embedding is not None:
+            self._cache.move_to_end(key)
+        return embedding
+
+    def _cache_put(self, key, embedding):
+        """Store a read-only copy of an embedding, evicting the least recently used entry when full."""
+        embedding = np.array(embedding, dtype=np.float32)
+        embedding.flags.writeable = False
+        self._cache[key] = embedding
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    def save_cache(self, cache_path=None):
+        """
+        Persist the embedding cache to disk so later runs can skip re-embedding.
+        
+        Args:
+            cache_path (str): Target .npz file. Defaults to the path given at init.
+        """
+        cache_path = cache_path or self.cache_path
+        if not cache_path:
+            raise ValueError("No cache_path given")
+        # Keys are stored as raw uint8 rows: numpy "S" strings would strip trailing null bytes
+        keys = np.frombuffer(b"".join(self._cache.keys()), dtype=np.uint8).reshape(len(self._cache), 16)
+        vectors = np.array(list(self._cache.values())).reshape(len(keys), 384)
+        np.savez(cache_path, keys=keys, vectors=vectors)
 
     def embed(self, text):
         """
@@ -38,34 +185,132 @@ class TextEmbedder:
         1. Tokenize text into model input format
         2. Pass through transformer model
         3. Apply mean pooling to get sentence-level embedding
-        4. Return as numpy array for database storage
+        4. Normalize to unit length
+        5. Return as numpy array for database storage
+        
+        Results are cached by content hash, so embedding the same text twice
+        only runs the model once.
         
         Args:
             text (str): Input text to embed
             
         Returns:
-            np.ndarray: 384-dimensional embedding vector
+            np.ndarray: 384-dimensional unit-length float32 embedding vector
         """
         if not text or not text.strip():
             # Return zero vector for empty text
-            return np.zeros(384)
-            
-        # Tokenize text with padding and truncation
+            return np.zeros(384, dtype=np.float32)
+        
+        key = self._cache_key(text)
+        embedding = self._cache_get(key)
+        if embedding is None:
+            embedding = self._embed_uncached(text)
+            self._cache_put(key, embedding)
+        # Return a writable float32 copy so callers can't modify the cached array;
+        # float32 matches the model's output and pgvector's wire format
+        return np.array(embedding, dtype=np.float32)
+
+    def _embed_uncached(self, text):
+        """Run the model on a single non-empty text, bypassing the cache."""
+        # Tokenize text with truncation
         inputs = self.tokenizer(
             text, 
             return_tensors="pt", 
             truncation=True, 
-            padding=True,
             max_length=512  # Limit input length for efficiency
         )
         
-        # Generate embeddings without computing gradients (inference only)
-        with torch.no_grad():
+        # Generate the mean-pooled embedding and return the first (and only) row
+        return self._forward(inputs)[0]
+
+    def embed_batch(self, texts, batch_size=EMBED_BATCH_SIZE):
+        """
+        Convert a list of texts into vector embeddings using batched forward passes.
+        
+        Batching amortizes tokenization and model overhead across all texts,
+        which is much faster than calling embed() once per text. Cached and
+        duplicate texts are only embedded once.
+        
+        Args:
+            texts (list[str]): Input texts to embed
+            batch_size (int): Maximum number of texts per forward pass
+            
+        Returns:
+            np.ndarray: float32 array of shape (len(texts), 384), one embedding per text
+        """
+        embeddings = np.zeros((len(texts), 384), dtype=np.float32)
+        
+        # Look up every non-empty text in the cache; empty texts keep zero vectors like embed()
+        keys = [self._cache_key(text) if text and text.strip() else None for text in texts]
+        found = {}
+        missing = {}
+        for text, key in zip(texts, keys):
+            if key is None or key in found or key in missing:
+                continue
+            embedding = self._cache_get(key)
+            if embedding is None:
+                missing[key] = text
+            else:
+                found[key] = embedding
+        
+        if missing:
+            new_embeddings = self._embed_batch_uncached(list(missing.values()), batch_size)
+            for key, embedding in zip(missing, new_embeddings):
+                self._cache_put(key, embedding)
+                found[key] = embedding
+        
+        for i, key in enumerate(keys):
+            if key is not None:
+                embeddings[i] = found[key]
+        return embeddings.astype(np.float32, copy=False)
+
+    def _embed_batch_uncached(self, texts, batch_size=EMBED_BATCH_SIZE):
+        """
+        Run the model on a list of non-empty texts, bypassing the cache.
+        
+        Uses smart batching: texts are sorted by token length and split into
+        micro-batches, so each batch is padded only to the length of similar
+        texts instead of the longest text overall. Results are returned in
+        the original order.
+        """
+        # Tokenize everything once, unpadded; micro-batches reuse these token ids
+        encodings = self.tokenizer(texts, truncation=True, max_length=512)
+        lengths = [len(ids) for ids in encodings["input_ids"]]
+        order = np.argsort(lengths, kind="stable")
+        
+        embeddings = np.zeros((len(texts), 384), dtype=np.float32)
+        for start in range(0, len(texts), batch_size):
+            indices = order[start:start + batch_size]
+            # Pad only this micro-batch, to its own longest text
+            inputs = self.tokenizer.pad(
+                {key: [values[i] for i in indices] for key, values in encodings.items()},
+                padding="longest",
+                return_tensors="pt",
+            )
+            embeddings[indices] = self._forward(inputs)
+        return embeddings
+
+    def _forward(self, inputs):
+        """Embed one tokenized batch in a single forward pass."""
+        inputs = {k: v.to(self.device) for k, v in inputs.items()}
+        
+        with self._autocast(), torch.no_grad():
             outputs = self.model(**inputs)
         
-        # Apply mean pooling to get sentence-level representation
-        # This averages token embeddings to create a single vector for the entire text
-        embeddings = outputs.last_hidden_state.mean(dim=1)
+        # Mean pooling over real tokens, one row per input text
+        return self._mean_pool(outputs.last_hidden_state, inputs["attention_mask"]).float().cpu().numpy()
+
+    @staticmethod
+    def _mean_pool(last_hidden_state, attention_mask):
+        """
+        Average token embeddings, ignoring padding positions, and scale to unit length.
         
-        # Convert to numpy array and return first (and only) embedding
-        return embeddings[0].numpy()
+        Padding tokens are masked out so a text's embedding does not depend
+        on how long the other texts in its batch are.
+        """
+        # Pool in FP32 so FP16 GPU outputs don't lose precision in the sum
+        mask = attention_mask.unsqueeze(-1).float()
+        summed = (last_hidden_state.float() * mask).sum(dim=1)
+        counts = mask.sum(dim=1).clamp(min=1e-9)
+        # L2-normalize so cosine similarity reduces to a plain inner product in the database
+        return torch.nn.functional.normalize(summed / counts, p=2, dim=1)
@@ -3,22 +3,26 @@
 # - Hugging Face transformers for text embeddings
 # - Neon PostgreSQL with pgvector for vector storage and similarity search
 
+import argparse
+
 from embedder import TextEmbedder
-from db import create_patient_vectors_table, insert_patient_vector, query_similar_vectors
+from db import create_patient_vectors_table, filter_new_patient_records, insert_patient_vectors_bulk, query_similar_vectors
 import numpy as np
 
-def main():
+def main(embedder):
     """
     Basic example: Semantic search for patient records.
     
     This demonstrates how similar symptoms can be found even when 
     different words are used (e.g., "tired" vs "fatigue").
+    
+    Args:
+        embedder (TextEmbedder): Shared embedding model
     """
     print("=== BASIC SEMANTIC SEARCH EXAMPLE ===")
     
-    # Step 1: Initialize database and embedding model
+    # Step 1: Initialize database
     create_patient_vectors_table()
-    embedder = TextEmbedder()
 
     # Step 2: Sample patient data with different ways of describing symptoms
     patient_records = [
@@ -29,10 +33,14 @@ def main():
 
     # Step 3: Convert text to embeddings and store in vector database
     print("Converting patient records to embeddings and storing...")
-    for patient_id, data_type, content in patient_records:
-        # Generate 384-dimensional embedding that captures semantic meaning
-        embedding = embedder.embed(content)
-        insert_patient_vector(patient_id, data_type, content, embedding)
+    # Records stored by an earlier run are skipped, so they are never re-embedded
+    new_records = filter_new_patient_records(patient_records)
+    # Generate 384-dimensional embeddings that capture semantic meaning, all in one batch
+    embeddings = embedder.embed_batch([content for _, _, content in new_records])
+    insert_patient_vectors_bulk(
+        (patient_id, data_type, content, embedding, None, None)
+        for (patient_id, data_type, content), embedding in zip(new_records, embeddings)
+    )
 
     # Step 4: Perform semantic similarity search
     # Notice how "tired" matches "fatigue" even though they're different words
@@ -51,19 +59,18 @@ def main():
         print(f"Content: {content}")
         print("-----")
 
-def drug_interaction_example():
+def drug_interaction_example(embedder):
     """
     Example 2: Drug Interaction Finder using semantic search.
     
     This shows how to find medications with similar effects or interactions,
     useful for identifying potential drug conflicts or alternatives.
+    
+    Args:
+        embedder (TextEmbedder): Shared embedding model
     """
     print("\n=== DRUG INTERACTION FINDER EXAMPLE ===")
     
-    # Create table if not exists
-    create_patient_vectors_table()
-    embedder = TextEmbedder()
-    
     # Sample medication data - each with unique patient IDs to avoid duplicates
     medications = [
         ("med_001", "medication", "Patient taking warfarin 5mg daily for blood clot prevention", "Dr. Smith", "visit_001"),
@@ -76,9 +83,12 @@ def drug_interaction_example():
     
     # Insert medication data
     print("Inserting medication records...")
-    for patient_id, data_type, content, doctor_id, visit_id in medications:
-        embedding = embedder.embed(content)
-        insert_patient_vector(patient_id, data_type, content, embedding, doctor_id, visit_id)
+    new_records = filter_new_patient_records(medications)
+    embeddings = embedder.embed_batch([content for _, _, content, *_ in new_records])
+    insert_patient_vectors_bulk(
+        (patient_id, data_type, content, embedding, doctor_id, visit_id)
+        for (patient_id, data_type, content, doctor_id, visit_id), embedding in zip(new_records, embeddings)
+    )
     
     # Query for blood thinning medications
     print("\n--- Searching for blood thinning medications ---")
@@ -93,17 +103,18 @@ def drug_interaction_example():
         print(f"Medication: {content}")
         print("-----")
 
-def temporal_patient_tracking_example():
+def temporal_patient_tracking_example(embedder):
     """
     Example 3: Temporal Patient Tracking using embeddings.
     
     This demonstrates tracking patient progress over time and finding
     similar recovery patterns across different patients and conditions.
+    
+    Args:
+        embedder (TextEmbedder): Shared embedding model
     """
     print("\n=== TEMPORAL PATIENT TRACKING EXAMPLE ===")
     
-    embedder = TextEmbedder()
-    
     # Sample patient timeline with dates
     patient_timeline = [
         ("patient_007", "consultation", "2024-01-15: Initial consultation for chest pain and shortness of breath", "Dr. Garcia", "visit_007_1"),
@@ -117,15 +128,22 @@ def temporal_patient_tracking_example():
     
     # Insert temporal data
     print("Inserting patient timeline records...")
-    for patient_id, data_type, content, doctor_id, visit_id in patient_timeline:
-        embedding = embedder.embed(content)
-        insert_patient_vector(patient_id, data_type, content, embedding, doctor_id, visit_id)
+    new_records = filter_new_patient_records(patient_timeline)
+    embeddings = embedder.embed_batch([content for _, _, content, *_ in new_records])
+    insert_patient_vectors_bulk(
+        (patient_id, data_type, content, embedding, doctor_id, visit_id)
+        for (patient_id, data_type, content, doctor_id, visit_id), embedding in zip(new_records, embeddings)
+    )
+    
+    # Embed both search queries up front in a single batch
+    recovery_query = "patient recovery symptoms improving getting better"
+    heart_query = "heart problems cardiac chest pain rhythm"
+    recovery_embedding, heart_embedding = embedder.embed_batch([recovery_query, heart_query])
     
     # Query for recovery patterns
     print("\n--- Searching for recovery and improvement patterns ---")
-    query_text = "patient recovery symptoms improving getting better"
-    query_embedding = embedder.embed(query_text)
-    results = query_similar_vectors(query_embedding, top_k=4)
+    query_text = recovery_query
+    results = query_similar_vectors(recovery_embedding, top_k=4)
     
     print(f"Query: '{query_text}'")
     print("Similar recovery patterns:")
@@ -136,9 +154,8 @@ def temporal_patient_tracking_example():
     
     # Query for specific condition progression
     print("\n--- Searching for heart-related conditions ---")
-    query_text = "heart problems cardiac chest pain rhythm"
-    query_embedding = embedder.embed(query_text)
-    results = query_similar_vectors(query_embedding, top_k=4)
+    query_text = heart_query
+    results = query_similar_vectors(heart_embedding, top_k=4)
     
     print(f"Query: '{query_text}'")
     print("Heart-related records:")
@@ -149,26 +166,35 @@ def temporal_patient_tracking_example():
 
 def clear_existing_data():
     """
-    Clear existing data to prevent duplicates when running examples.
+    Clear all stored records, e.g. to re-embed everything after changing the model.
+    Run with: python main.py --reset
     
-    In a production system, you'd want more sophisticated data management,
-    but for demos this ensures clean results each time.
+    Re-running the examples does not need this: records that are already
+    stored are skipped and duplicate inserts are ignored.
     """
     from db import get_db_connection
-    conn = get_db_connection()
-    with conn.cursor() as cur:
-        cur.execute("DELETE FROM patient_data_vectors;")
-        conn.commit()
-    conn.close()
-    print("Cleared existing data to prevent duplicates.\n")
+    create_patient_vectors_table()
+    with get_db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("DELETE FROM patient_data_vectors;")
+            conn.commit()
+    print("Cleared existing data.\n")
 
 if __name__ == "__main__":
-    # Clear existing data to prevent duplicates
-    clear_existing_data()
+    parser = argparse.ArgumentParser(description="Vector embedding search demo for healthcare data")
+    parser.add_argument("--reset", action="store_true",
+                        help="delete all stored records before running, so everything is re-embedded")
+    args = parser.parse_args()
+    
+    if args.reset:
+        clear_existing_data()
+    
+    # Load the embedding model once and share it across all examples
+    embedder = TextEmbedder()
     
     # Run original example
-    main()
+    main(embedder)
     
     # Run new examples
-    drug_interaction_example()
-    temporal_patient_tracking_example()
+    drug_interaction_example(embedder)
+    temporal_patient_tracking_example(embedder)